@@ -12,17 +12,26 @@ You can override that with:
 from __future__ import annotations
 
 import argparse
+import functools
+import mmap
 import os
+import re
+import shutil
+import stat
+import tempfile
 from pathlib import Path
-from typing import List
 
 
+@functools.lru_cache(maxsize=1)
 def get_vlc_config_file() -> Path:
     """
     Return the path to the VLC config file (vlcrc) for the current user.
 
     On Windows this is normally:
         %APPDATA%\vlc\vlcrc
+
+    The result is cached, so the config directory is resolved (and
+    created if missing) only once per run.
     """
     appdata = os.environ.get("APPDATA")
     if not appdata:
@@ -34,39 +43,56 @@ def get_vlc_config_file() -> Path:
 
 def backup_file(path: Path) -> None:
     """
-    Make a simple .bak backup if the file exists and no backup exists yet.
+    Make a simple .bak backup if no backup exists yet.
+
+    The caller is expected to have checked that path exists.
     """
-    if path.exists():
-        backup = path.with_suffix(path.suffix + ".bak")
-        if not backup.exists():
-            backup.write_bytes(path.read_bytes())
+    backup = path.with_suffix(path.suffix + ".bak")
+    if not backup.exists():
+        # copyfile stays kernel-side where the platform supports it,
+        # instead of round-tripping the whole file through Python.
+        shutil.copyfile(path, backup)
+
 
+# Matches a soundfont= line (commented or not), including its newline.
+_SOUNDFONT_RE = re.compile(r"(?m)^[ \t]*#?soundfont=.*\n?")
 
-def update_soundfont_in_lines(lines: List[str], sf_path: Path) -> List[str]:
+
+def update_soundfont_in_text(text: str, sf_path: Path) -> str:
     """
     Update or append the soundfont= line in an existing vlcrc content.
     """
     target_line = f'soundfont="{sf_path}"\n'
-    updated: List[str] = []
-    found = False
 
-    for line in lines:
-        stripped = line.lstrip()
-        if stripped.startswith("soundfont=") or stripped.startswith("#soundfont="):
-            # Replace any existing soundfont setting (commented or not)
-            updated.append(target_line)
-            found = True
-        else:
-            updated.append(line)
+    # Replace the first soundfont= line (commented or not) by splicing
+    # at the match position, then drop any duplicates after it. Splicing
+    # also keeps backslashes in Windows paths out of replacement-escape
+    # handling, and the match offsets pin down exactly which line was
+    # rewritten even when the path text appears elsewhere in the file.
+    m = _SOUNDFONT_RE.search(text)
+    if m:
+        keep_end = m.start() + len(target_line)
+        new_text = text[:m.start()] + target_line + text[m.end():]
+        return new_text[:keep_end] + _SOUNDFONT_RE.sub("", new_text[keep_end:])
 
-    if not found:
-        # Append at the end if nothing was found
-        if updated and not updated[-1].endswith("\n"):
-            updated[-1] = updated[-1] + "\n"
-        updated.append("\n# Set by configure_vlc_soundfont.py\n")
-        updated.append(target_line)
+    # Append at the end if nothing was found
+    if text and not text.endswith("\n"):
+        text += "\n"
+    return text + f"\n# Set by configure_vlc_soundfont.py\n{target_line}"
 
-    return updated
+
+def _has_soundfont_bytes(path: Path) -> bool:
+    """
+    Check for a soundfont= setting without decoding the file, by
+    mmap-ing it and searching the raw bytes.
+    """
+    with open(path, "rb") as fh:
+        try:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return buf.find(b"soundfont=") >= 0
+        except ValueError:
+            # Zero-length files cannot be mapped and have no setting.
+            return False
 
 
 def configure_vlc_soundfont(sf_path: Path) -> Path:
@@ -74,23 +100,69 @@ def configure_vlc_soundfont(sf_path: Path) -> Path:
     Ensure vlcrc exists and points VLC at the given SoundFont path.
     Returns the path to vlcrc.
     """
-    if not sf_path.is_file():
+    # One stat answers both "does it exist" and "is it a regular file".
+    try:
+        sf_mode = os.stat(sf_path).st_mode
+    except OSError:
+        sf_mode = 0
+    if not stat.S_ISREG(sf_mode):
         raise FileNotFoundError(f"SoundFont not found: {sf_path}")
 
     vlcrc = get_vlc_config_file()
-    backup_file(vlcrc)
 
-    if vlcrc.exists():
+    # Likewise stat vlcrc once and reuse the answer for the backup
+    # decision and the read-vs-create branch below.
+    try:
+        os.stat(vlcrc)
+        vlcrc_exists = True
+    except OSError:
+        vlcrc_exists = False
+
+    if vlcrc_exists:
+        backup_file(vlcrc)
+
+    target_line = f'soundfont="{sf_path.resolve()}"\n'
+
+    if vlcrc_exists:
+        if not _has_soundfont_bytes(vlcrc):
+            # No line to rewrite: append the setting in place without
+            # reading or decoding the rest of the file.
+            with open(vlcrc, "r+b") as fh:
+                fh.seek(0, os.SEEK_END)
+                if fh.tell() > 0:
+                    fh.seek(-1, os.SEEK_END)
+                    if fh.read(1) != b"\n":
+                        fh.write(b"\n")
+                fh.write(
+                    b"\n# Set by configure_vlc_soundfont.py\n"
+                    + target_line.encode("utf-8")
+                )
+            return vlcrc
         text = vlcrc.read_text(encoding="utf-8", errors="ignore")
-        lines = text.splitlines(keepends=True)
     else:
-        lines = []
+        text = ""
 
-    new_lines = update_soundfont_in_lines(lines, sf_path.resolve())
-    vlcrc.write_text("".join(new_lines), encoding="utf-8")
+    new_text = update_soundfont_in_text(text, sf_path.resolve())
+    if new_text != text:
+        _atomic_write_text(vlcrc, new_text)
     return vlcrc
 
 
+def _atomic_write_text(path: Path, text: str) -> None:
+    """
+    Write text to path atomically via a tempfile in the same directory,
+    so a crash mid-write can never leave a truncated vlcrc behind.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+            tmp.write(text)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
 def parse_args() -> argparse.Namespace:
     """
     Parse CLI arguments.
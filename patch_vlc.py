@@ -21,12 +21,18 @@ Usage examples:
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import os
+import re
 import subprocess
 import sys
 import shutil
+import tempfile
 import textwrap
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 
 DEFAULT_REMOTE = "https://code.videolan.org/videolan/vlc.git"
@@ -37,9 +43,13 @@ def run(
     cmd: List[str],
     cwd: Optional[Path] = None,
     env: Optional[dict] = None,
-) -> None:
+    check: bool = True,
+) -> int:
     """
-    Run a command, streaming stdout/stderr, raising on failure.
+    Run a command, streaming stdout/stderr.
+
+    With check=True (the default) a failure terminates the script;
+    with check=False the return code is returned to the caller.
     """
     print(f"\n[RUN] {' '.join(cmd)}")
     try:
@@ -48,17 +58,34 @@ def run(
             cwd=str(cwd) if cwd else None,
             env=env,
             check=True,
+            # Merge stderr into stdout so child output arrives on one
+            # stream in order. On Windows, inheriting handles as-is
+            # avoids the per-handle work done when closing fds.
+            stderr=subprocess.STDOUT,
+            close_fds=(os.name != "nt"),
         )
     except subprocess.CalledProcessError as exc:
-        print(f"[ERROR] Command failed: {exc}", file=sys.stderr)
-        sys.exit(exc.returncode)
+        if check:
+            print(f"[ERROR] Command failed: {exc}", file=sys.stderr)
+            sys.exit(exc.returncode)
+        return exc.returncode
+    return 0
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> Optional[str]:
+    """
+    shutil.which with the result cached, so repeated checks for the same
+    tool do not rescan every PATH entry.
+    """
+    return shutil.which(name)
 
 
 def check_tool(name: str) -> None:
     """
     Ensure an external tool is available on PATH.
     """
-    if shutil.which(name) is None:
+    if _which(name) is None:
         print(f"[ERROR] Required tool not found on PATH: {name}",
               file=sys.stderr)
         sys.exit(1)
@@ -68,10 +95,15 @@ def ensure_repo(
     work_dir: Path,
     remote: str,
     branch: str,
+    full_history: bool = False,
 ) -> Path:
     """
     Clone VLC repo into work_dir/vlc if missing, otherwise update it.
 
+    By default the clone is shallow and blob-filtered; full_history=True
+    clones and fetches the complete history instead (needed for git log
+    archaeology, bisecting, or pushing work back upstream).
+
     Returns the path to the VLC repo directory.
     """
     repo_dir = work_dir / "vlc"
@@ -79,45 +111,370 @@ def ensure_repo(
     if not repo_dir.exists():
         print(f"[INFO] Cloning VLC into {repo_dir}")
         work_dir.mkdir(parents=True, exist_ok=True)
-        run(["git", "clone", remote, str(repo_dir)])
-    else:
-        print(f"[INFO] VLC repo exists at {repo_dir}, fetching updates")
-        run(["git", "fetch", "origin"], cwd=repo_dir)
+        cmd = ["git", "clone"]
+        if not full_history:
+            # History and foreign-branch blobs are dead weight for a
+            # patch-and-build tree: clone only the tip of the wanted
+            # branch and let blobs be fetched on demand.
+            cmd.extend(["--filter=blob:none", "--depth=1",
+                        "--single-branch"])
+        cmd.extend(["--branch", branch, remote, str(repo_dir)])
+        run(cmd)
+        return repo_dir
+
+    # Two git processes instead of three: fetch just the wanted branch,
+    # then point the local branch at it directly. checkout -B replaces
+    # the old checkout + pull pair and avoids a working-tree merge.
+    # Note --depth=1 also shallows a pre-existing full clone; pass
+    # full_history to keep (or restore) complete history.
+    print(f"[INFO] VLC repo exists at {repo_dir}, fetching updates")
+    fetch_cmd = ["git", "-c", "protocol.version=2", "fetch"]
+    if not full_history:
+        fetch_cmd.append("--depth=1")
+    elif (repo_dir / ".git" / "shallow").exists():
+        # A plain fetch does not deepen a shallow clone; --unshallow is
+        # what actually retrieves the missing history.
+        fetch_cmd.append("--unshallow")
+    fetch_cmd.extend(["--prune", "origin", branch])
+    run(fetch_cmd, cwd=repo_dir)
+    # If we are already on the branch at the fetched tip, the checkout
+    # (and its working-tree scan) is pure overhead; skip it.
+    head = _git_output(["rev-parse", "--verify", "HEAD"], repo_dir)
+    upstream = _git_output(
+        ["rev-parse", "--verify", f"origin/{branch}"], repo_dir,
+    )
+    on_branch = _git_output(["rev-parse", "--abbrev-ref", "HEAD"], repo_dir)
+    if head is not None and head == upstream and on_branch == branch:
+        print(f"[INFO] Branch {branch} already at origin/{branch}")
+        return repo_dir
 
     print(f"[INFO] Checking out branch {branch}")
-    run(["git", "checkout", branch], cwd=repo_dir)
-    run(["git", "pull", "origin", branch], cwd=repo_dir)
+    run(["git", "checkout", "-B", branch, f"origin/{branch}"], cwd=repo_dir)
 
     return repo_dir
 
 
+_DIGIT_RUN_RE = re.compile(r"(\d+)")
+
+
+def _natural_key(name: str) -> List[object]:
+    """
+    Sort key treating digit runs as numbers, so 2-foo.patch sorts before
+    10-bar.patch. sorted() computes this once per entry.
+    """
+    return [
+        int(part) if part.isdigit() else part.lower()
+        for part in _DIGIT_RUN_RE.split(name)
+    ]
+
+
+def _list_patch_files(patches_dir: Path) -> List[Path]:
+    """
+    Return .patch files in patches_dir in natural-sort order.
+
+    os.scandir yields names and file types from the directory read
+    itself, avoiding the extra stat per entry that glob incurs.
+    """
+    with os.scandir(patches_dir) as entries:
+        names = [
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".patch") and entry.is_file()
+        ]
+    names.sort(key=_natural_key)
+    return [patches_dir / name for name in names]
+
+
+# Config tuned for long patch sequences: split index and index v4 shrink
+# index writes, skipHash drops the SHA pass over the index on every write,
+# and fsync/gc are pointless for a tree we are about to rebuild anyway.
+_APPLY_CONFIG = {
+    "core.splitIndex": "true",
+    "index.skipHash": "true",
+    "core.fsync": "none",
+    "gc.auto": "0",
+}
+
+# The same keys as -c overrides, passed on every git apply argv so they
+# hold even for subprocesses git may spawn itself.
+_APPLY_CONFIG_ARGS = [
+    arg
+    for key, value in _APPLY_CONFIG.items()
+    for arg in ("-c", f"{key}={value}")
+]
+
+
+def _git_output(args: List[str], repo_dir: Path) -> Optional[str]:
+    """
+    Run a git command and return its stripped stdout, or None on failure.
+    """
+    result = subprocess.run(
+        ["git", *args],
+        cwd=str(repo_dir),
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def _git_config_get(repo_dir: Path, key: str) -> Optional[str]:
+    """
+    Read a git config value from the repo, or None if unset.
+    """
+    return _git_output(["config", "--get", key], repo_dir)
+
+
+@contextlib.contextmanager
+def _fast_index(repo_dir: Path):
+    """
+    Temporarily configure the repo for fast index rewrites during the
+    apply phase, restoring the previous config values on exit.
+    """
+    previous = {key: _git_config_get(repo_dir, key) for key in _APPLY_CONFIG}
+    for key, value in _APPLY_CONFIG.items():
+        run(["git", "config", key, value], cwd=repo_dir, check=False)
+    run(
+        ["git", "update-index", "--index-version", "4"],
+        cwd=repo_dir,
+        check=False,
+    )
+    try:
+        yield
+    finally:
+        for key, prev in previous.items():
+            if prev is None:
+                run(["git", "config", "--unset", key],
+                    cwd=repo_dir, check=False)
+            else:
+                run(["git", "config", key, prev], cwd=repo_dir, check=False)
+
+
+def _check_patch_in_worktree(
+    repo_dir: str,
+    patch: str,
+    reverse: bool,
+) -> Tuple[str, int, str]:
+    """
+    Check a single patch against a throwaway detached worktree.
+
+    Runs in a worker process; returns (patch name, return code, output)
+    so the parent can print results attributed to the right patch.
+
+    The worktree checks out committed HEAD, so this only answers "does
+    the patch fit a pristine tree" — it cannot see uncommitted
+    working-tree state and must not gate the real apply.
+    """
+    name = Path(patch).name
+    scratch = tempfile.mkdtemp(prefix="vlc-patch-check-")
+    try:
+        result = subprocess.run(
+            ["git", "worktree", "add", "--detach", scratch],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return name, result.returncode, result.stderr
+        cmd = ["git", "apply", "--check"]
+        if reverse:
+            cmd.append("--reverse")
+        cmd.append(patch)
+        result = subprocess.run(
+            cmd,
+            cwd=scratch,
+            capture_output=True,
+            text=True,
+        )
+        return name, result.returncode, result.stdout + result.stderr
+    finally:
+        subprocess.run(
+            ["git", "worktree", "remove", "--force", scratch],
+            cwd=repo_dir,
+            capture_output=True,
+        )
+
+
+def _isolate_failing_patches(
+    repo_dir: Path,
+    patch_files: List[Path],
+    reverse: bool,
+) -> List[Path]:
+    """
+    Check patches concurrently against scratch worktrees and return the
+    ones that fail against a pristine HEAD. Falls back to serial checks
+    in the main tree if git worktree is unavailable.
+
+    Diagnosis only: patches that depend on earlier patches in the series
+    legitimately fail here, so the result enriches error reports but
+    must never decide whether the real apply proceeds.
+    """
+    have_worktree = subprocess.run(
+        ["git", "worktree", "list"],
+        cwd=str(repo_dir),
+        capture_output=True,
+    ).returncode == 0
+
+    failed: List[Path] = []
+    if have_worktree and len(patch_files) > 1:
+        max_workers = max(1, (os.cpu_count() or 1) - 2)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+        ) as pool:
+            futures = {
+                pool.submit(
+                    _check_patch_in_worktree,
+                    str(repo_dir),
+                    str(patch),
+                    reverse,
+                ): patch
+                for patch in patch_files
+            }
+            # Buffer worker output and flush once: one write instead of
+            # a syscall per line, and no interleaving between patches.
+            buffered: List[str] = []
+            for future in concurrent.futures.as_completed(futures):
+                name, returncode, output = future.result()
+                buffered.extend(
+                    f"[{name}] {line}\n" for line in output.splitlines()
+                )
+                if returncode != 0:
+                    failed.append(futures[future])
+            if buffered:
+                sys.stderr.write("".join(buffered))
+                sys.stderr.flush()
+    else:
+        for patch in patch_files:
+            cmd = ["git", "apply", "--check"]
+            if reverse:
+                cmd.append("--reverse")
+            cmd.append(str(patch))
+            if run(cmd, cwd=repo_dir, check=False) != 0:
+                failed.append(patch)
+
+    return sorted(failed)
+
+
 def apply_patches(
     repo_dir: Path,
     patches_dir: Path,
     reverse: bool = False,
+    cached: bool = False,
 ) -> None:
     """
     Apply all .patch files in patches_dir (sorted by name) using git apply.
 
-    If reverse=True, patches are reversed (for cleanup).
+    If reverse=True, patches are reversed (for cleanup). If cached=True,
+    patches are applied to the index only (--cached --3way), skipping
+    working-tree writes; useful when the tree will be rebuilt anyway or
+    checked out later in one go.
     """
     if not patches_dir.exists():
         print(f"[INFO] No patches directory found: {patches_dir}")
         return
 
-    patch_files = sorted(patches_dir.glob("*.patch"))
+    patch_files = _list_patch_files(patches_dir)
     if not patch_files:
         print(f"[INFO] No .patch files found in {patches_dir}")
         return
 
     print(f"[INFO] Applying patches from {patches_dir}")
+    with _fast_index(repo_dir):
+        _apply_patch_files(repo_dir, patch_files, reverse, cached)
+
+
+def _apply_cmd(reverse: bool, cached: bool) -> List[str]:
+    """
+    Build the base git apply argv for the requested mode.
+    """
+    cmd = ["git", *_APPLY_CONFIG_ARGS, "apply"]
+    if reverse:
+        cmd.append("--reverse")
+    if cached:
+        cmd.extend(["--cached", "--3way"])
+    return cmd
+
+
+def _undo_partial_batch(
+    repo_dir: Path,
+    patch_files: List[Path],
+    reverse: bool,
+    cached: bool,
+) -> None:
+    """
+    Best-effort rollback after a failed batched apply: any patch whose
+    undo checks cleanly was landed by the batch, so undo it. Walks the
+    list last-to-first so dependent patches unwind in order.
+    """
+    for patch in reversed(patch_files):
+        undo = _apply_cmd(not reverse, cached)
+        if run(undo + ["--check", str(patch)], cwd=repo_dir,
+               check=False) == 0:
+            run(undo + [str(patch)], cwd=repo_dir, check=False)
+
+
+def _apply_patch_files(
+    repo_dir: Path,
+    patch_files: List[Path],
+    reverse: bool,
+    cached: bool = False,
+) -> None:
+    """
+    Apply the given patch files, batched first with a per-patch fallback.
+    """
+    file_args = [str(p) for p in patch_files]
+
+    # Validate the whole set with one git apply --check before touching
+    # anything: a bad patch in an independent set is caught while the
+    # tree is pristine. The check only proves each patch fits the
+    # current tree, not the cumulative result of the sequence, so the
+    # batched apply can still fail midway (e.g. two patches cut against
+    # the same base touching one file); that failure takes the serial
+    # path below just like a failed check. git apply accepts multiple
+    # patch files, so each batched call is one fork and one index
+    # rewrite instead of N.
+    if run(
+        _apply_cmd(reverse, cached) + ["--check"] + file_args,
+        cwd=repo_dir,
+        check=False,
+    ) == 0:
+        if run(
+            _apply_cmd(reverse, cached) + file_args,
+            cwd=repo_dir,
+            check=False,
+        ) == 0:
+            return
+        # The batch may have landed some patches before failing; undo
+        # them so the serial fallback starts from the pre-batch state.
+        print("[WARN] Batch apply failed, rolling back and applying "
+              "patches serially", file=sys.stderr)
+        _undo_partial_batch(repo_dir, patch_files, reverse, cached)
+    else:
+        # Expected for dependent series: a later patch touching a file
+        # an earlier one changed fails the batched check even though it
+        # applies fine in order.
+        print("[WARN] Batch pre-check failed, applying patches serially",
+              file=sys.stderr)
     for patch in patch_files:
         print(f"[INFO] Applying patch: {patch.name}")
-        cmd = ["git", "apply"]
-        if reverse:
-            cmd.append("--reverse")
+        cmd = _apply_cmd(reverse, cached)
         cmd.append(str(patch))
-        run(cmd, cwd=repo_dir)
+        if run(cmd, cwd=repo_dir, check=False) != 0:
+            print(f"[ERROR] Patch failed to apply: {patch.name}",
+                  file=sys.stderr)
+            # Enrich the report: which patches fail even against a
+            # pristine HEAD? Only meaningful in forward mode, since the
+            # reverse ground truth is the uncommitted working tree,
+            # which a scratch worktree cannot see.
+            if not reverse:
+                broken = _isolate_failing_patches(repo_dir, patch_files,
+                                                  reverse)
+                if broken:
+                    sys.stderr.write("".join(
+                        f"[ERROR] Also fails against pristine HEAD: "
+                        f"{p.name}\n"
+                        for p in broken
+                    ))
+            sys.exit(1)
 
 
 def configure_vlc(
@@ -250,6 +607,18 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Reverse patches instead of applying them (cleanup).",
     )
+    parser.add_argument(
+        "--full-history",
+        action="store_true",
+        help=("Clone and fetch full history instead of the default "
+              "shallow, blob-filtered clone."),
+    )
+    parser.add_argument(
+        "--apply-cached",
+        action="store_true",
+        help=("Apply patches to the index only (git apply --cached "
+              "--3way), skipping working-tree writes."),
+    )
 
     return parser.parse_args()
 
@@ -276,12 +645,14 @@ def main() -> None:
         work_dir=work_dir,
         remote=args.remote,
         branch=args.branch,
+        full_history=args.full_history,
     )
 
     apply_patches(
         repo_dir=repo_dir,
         patches_dir=patches_dir,
         reverse=args.reverse_patches,
+        cached=args.apply_cached,
     )
 
     if args.apply_only: